@@ -16,7 +16,46 @@ push_flag = click.option('--push/--no-push', 'push_statusdb',
     default = None,
     help = 'Push / do not push MultiQC results to StatusDB analysis db. Overrides config option push_statusdb'
 )
+force_ngi = click.option('--force-ngi', 'force_ngi',
+    is_flag = True,
+    help = "Push to StatusDB and copy the report to the remote server even if nothing has changed since the last run"
+)
+ngi_profile = click.option('--ngi-profile', 'ngi_profile',
+    is_flag = True,
+    help = "Profile CPU time and memory use of the MultiQC_NGI hooks. Results are saved in the data directory."
+)
 test_db = click.option('--test-db', 'test_database',
     default = None,
     help = "Path to a static file to use for testing instead of StatusDB. Useful for testing when the NGI database isn't accessible."
 )
+
+
+@click.group()
+def multiqc_ngi():
+    """ MultiQC_NGI command line tools """
+    pass
+
+
+@multiqc_ngi.command()
+@click.option('--metrics-db', required = True, type = click.Path(dir_okay = False),
+    help = "SQLite file with the metrics table to update. Created if it doesn't exist."
+)
+@click.option('--batch-size', default = 100, show_default = True, type = click.IntRange(min = 1),
+    help = "Number of analysis documents to fetch from StatusDB at a time"
+)
+@click.option('--max-docs', default = None, type = click.IntRange(min = 1),
+    help = "Stop after this many documents. Run again to carry on from the checkpoint."
+)
+def export(metrics_db, batch_size, max_docs):
+    """ Export new and updated MultiQC_data documents from the StatusDB
+    analysis database to a local metrics table """
+    from multiqc_ngi.export import export_analysis_db
+    stats = export_analysis_db(metrics_db, batch_size = batch_size, max_docs = max_docs)
+    click.echo(
+        f"Exported {stats['docs']} documents ({stats['deleted']} deleted) and {stats['rows']} rows "
+        f"in {stats['batches']} batches, {stats['seconds']:.1f}s "
+        f"({stats['docs_per_second']:.1f} docs/s, {stats['rows_per_second']:.0f} rows/s)"
+    )
+    if stats['skipped'] > 0:
+        click.echo(f"Skipped {stats['skipped']} documents that could not be exported - see the log for their IDs")
+    click.echo(f"Checkpoint moved from {stats['since']} to {stats['checkpoint']}")
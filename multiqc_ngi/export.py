@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+""" Incremental export of the StatusDB analysis database to the local
+metrics table. Follows analysis/_changes from the last checkpoint, so
+only new or updated MultiQC_data documents are downloaded. """
+
+import logging
+import time
+
+from ibmcloudant import CouchDbSessionAuthenticator, cloudant_v1
+
+from multiqc_ngi.metrics_store import MetricsStore
+from multiqc_ngi.multiqc_ngi import load_statusdb_config
+
+log = logging.getLogger('multiqc')
+
+CHECKPOINT_KEY = 'analysis_changes_seq'
+
+
+def export_analysis_db(metrics_db, batch_size=100, max_docs=None, timeout=60):
+    """ Copy new and updated MultiQC_data documents from the analysis
+    database into the metrics table at metrics_db.
+
+    Documents are fetched batch_size at a time and each batch is written
+    together with the new checkpoint, so memory use is bounded and an
+    interrupted export carries on where it left off.
+    Returns a dict of throughput metrics for this run. """
+
+    sdb_config = load_statusdb_config()
+    if sdb_config is None:
+        raise RuntimeError("Could not load the StatusDB config")
+    couch_user, password, couch_url = sdb_config
+    couch = cloudant_v1.CloudantV1(authenticator=CouchDbSessionAuthenticator(couch_user, password))
+    couch.set_service_url(f"https://{couch_url}")
+    couch.set_http_config({'timeout': timeout})
+
+    stats = {'batches': 0, 'docs': 0, 'deleted': 0, 'skipped': 0, 'rows': 0}
+    start = time.monotonic()
+    with MetricsStore(metrics_db) as store:
+        since = store.get_state(CHECKPOINT_KEY, '0')
+        stats['since'] = since
+        while max_docs is None or stats['docs'] < max_docs:
+            limit = batch_size if max_docs is None else min(batch_size, max_docs - stats['docs'])
+            changes = couch.post_changes(
+                db='analysis',
+                filter='_selector',
+                # Deleted docs only keep _id, _rev and _deleted, so let them through too
+                selector={'$or': [{'entity_type': 'MultiQC_data'}, {'_deleted': True}]},
+                include_docs=True,
+                limit=limit,
+                since=since,
+            ).get_result()
+            if len(changes['results']) == 0:
+                break
+            since = changes['last_seq']
+            n_rows, n_skipped = store.apply_changes(changes['results'], CHECKPOINT_KEY, since)
+            stats['rows'] += n_rows
+            stats['skipped'] += n_skipped
+            stats['batches'] += 1
+            stats['docs'] += len(changes['results'])
+            stats['deleted'] += sum(1 for c in changes['results'] if c.get('deleted'))
+            log.debug(f"Exported batch {stats['batches']}: {stats['docs']} documents, {changes.get('pending', 0)} pending")
+            if changes.get('pending', 0) == 0:
+                break
+    stats['checkpoint'] = since
+    stats['seconds'] = time.monotonic() - start
+    stats['docs_per_second'] = stats['docs'] / stats['seconds'] if stats['seconds'] > 0 else 0
+    stats['rows_per_second'] = stats['rows'] / stats['seconds'] if stats['seconds'] > 0 else 0
+    return stats
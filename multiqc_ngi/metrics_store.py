@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+""" Local SQLite copy of the metrics pushed to the StatusDB analysis
+database. Each (project, module, sample, metric) gets its own row, so
+cross-project meta-analyses can scan a single table instead of
+downloading and parsing every nested analysis record. """
+
+import json
+import logging
+import math
+import os
+import sqlite3
+import time
+
+log = logging.getLogger('multiqc')
+
+# Rows are clustered on (project_id, module), which partitions the table by
+# project and module. A second index covers scans of one module / metric
+# across all projects. A project can have several MultiQC_data documents
+# (a new one is started for each MultiQC / MultiQC_NGI version), so doc_id
+# is part of the key and each document keeps its own rows.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS metrics (
+    project_id TEXT NOT NULL,
+    module TEXT NOT NULL,
+    sample TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    value REAL,
+    value_text TEXT,
+    doc_id TEXT NOT NULL,
+    updated REAL,
+    PRIMARY KEY (project_id, module, sample, metric, doc_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS metrics_module_metric ON metrics (module, metric);
+CREATE INDEX IF NOT EXISTS metrics_doc_id ON metrics (doc_id);
+CREATE TABLE IF NOT EXISTS state (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+def flatten_metrics(data, prefix=''):
+    """ Yield (metric, value) pairs from a module's data for one sample.
+    Nested dicts are joined with dots, lists are kept as JSON strings. """
+    if isinstance(data, dict):
+        for k, v in data.items():
+            yield from flatten_metrics(v, f"{prefix}.{k}" if prefix else str(k))
+    elif isinstance(data, (list, tuple)):
+        yield (prefix or 'value', json.dumps(data))
+    else:
+        yield (prefix or 'value', data)
+
+
+def doc_rows(doc, doc_id):
+    """ Yield one metrics table row per (sample, module, metric) in a
+    MultiQC_data analysis document. Raises ValueError if the document
+    has no project_id. """
+    project_id = doc.get('project_id')
+    if not project_id:
+        raise ValueError(f"Document {doc_id} has no project_id")
+    updated = time.time()
+    for sample, modules in doc.get('samples', {}).items():
+        for module, data in modules.items():
+            for metric, v in flatten_metrics(data):
+                value = None
+                value_text = None
+                if isinstance(v, (int, float)):
+                    if not (isinstance(v, float) and math.isnan(v)):
+                        value = float(v)
+                elif v is not None:
+                    value_text = str(v)
+                yield (project_id, module, sample, metric, value, value_text, doc_id, updated)
+
+
+class MetricsStore():
+    """ Read / write access to the local metrics table """
+
+    def __init__(self, path):
+        path = os.path.expanduser(path)
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Generous timeout, as several MultiQC runs may write at the same time
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.executescript(SCHEMA)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.db.close()
+
+    def write_doc(self, doc, doc_id):
+        """ Replace the rows for an analysis document. Returns the number of rows written. """
+        with self.db:
+            return self._replace_doc(doc, doc_id)
+
+    def apply_changes(self, changes, checkpoint_key, checkpoint):
+        """ Apply a batch of rows from a CouchDB _changes feed and move the
+        checkpoint on, all in one transaction so that an interrupted export
+        can resume without losing or duplicating anything. Documents that
+        can't be turned into rows are logged and skipped, so that one bad
+        document doesn't hold the checkpoint back for good.
+        Returns the number of rows written and the number of skipped documents. """
+        n_rows = 0
+        n_skipped = 0
+        with self.db:
+            for change in changes:
+                if change.get('deleted') or change.get('doc') is None:
+                    self.db.execute('DELETE FROM metrics WHERE doc_id = ?', (change['id'],))
+                    continue
+                try:
+                    rows = list(doc_rows(change['doc'], change['id']))
+                except (ValueError, TypeError, AttributeError) as e:
+                    log.warning(f"Skipping analysis document {change['id']}: {e}")
+                    # Don't keep rows from an earlier, valid revision of the document
+                    self.db.execute('DELETE FROM metrics WHERE doc_id = ?', (change['id'],))
+                    n_skipped += 1
+                    continue
+                n_rows += self._replace_rows(rows, change['id'])
+            self.db.execute('INSERT OR REPLACE INTO state VALUES (?, ?)', (checkpoint_key, checkpoint))
+        return n_rows, n_skipped
+
+    def get_state(self, key, default=None):
+        row = self.db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+        return default if row is None else row[0]
+
+    def _replace_doc(self, doc, doc_id):
+        return self._replace_rows(doc_rows(doc, doc_id), doc_id)
+
+    def _replace_rows(self, rows, doc_id):
+        self.db.execute('DELETE FROM metrics WHERE doc_id = ?', (doc_id,))
+        # Keys like 'a.b' and {'a': {'b': ..}} flatten to the same metric,
+        # in which case the last value wins
+        unique_rows = {(row[1], row[2], row[3]): row for row in rows}
+        cursor = self.db.executemany(
+            'INSERT INTO metrics VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            unique_rows.values()
+        )
+        return cursor.rowcount
@@ -4,15 +4,22 @@ core here to add in extra functionality. """
 
 from __future__ import print_function
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
+import fcntl
 import logging
 from ibmcloudant import CouchDbSessionAuthenticator, cloudant_v1
 from ibm_cloud_sdk_core import ApiException
+import hashlib
 import json
 import os
 import re
 import requests
+import sqlite3
 import subprocess
+import time
 import yaml
+from urllib.parse import urlparse
 
 from importlib.metadata import version
 
@@ -20,6 +27,9 @@ __version__ = version("multiqc_ngi")
 
 from multiqc import report, config, utils
 
+from multiqc_ngi.metrics_store import MetricsStore
+from multiqc_ngi.profiling import json_size, profile_ngi_hook
+
 log = logging.getLogger('multiqc')
 log.setLevel(logging.DEBUG)
 
@@ -49,19 +59,240 @@ def multiqc_ngi_config():
         '*/piper_ngi/04_merged_alignments/*'
     ])
 
+    # Also write pushed metrics to a local SQLite table (disabled by default)
+    config.ngi_metrics_db = None
+
     # Save generated reports remotely on the tools server
     config.save_remote = False
     config.remote_sshkey = None
     config.remote_port = None
     config.remote_destination = None
 
+    # Maximum number of concurrent StatusDB requests for multi-project reports
+    config.ngi_max_workers = 4
+
+    # Total time allowed for talking to StatusDB, eg. '20s' (no limit by default)
+    config.ngi_time_budget = None
+
+    # Skip StatusDB for a cool-down period after repeated failures
+    config.ngi_breaker_threshold = 3
+    config.ngi_breaker_cooldown = 600
+
+    # Where to keep StatusDB metadata and circuit breaker state between runs
+    config.ngi_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'multiqc_ngi')
+
     # General MultiQC_NGI options
     config.disable_ngi = False
 
 
+# Errors which mean that StatusDB could not be reached or did not answer in time
+STATUSDB_ERRORS = (ConnectionError, requests.exceptions.RequestException, ApiException)
+
+
+def parse_duration(value):
+    """ Parse a duration such as 20, '20s', '1.5m' or '1h' into seconds.
+    Returns None if no duration is set. """
+    if value is None or value == '':
+        return None
+    if isinstance(value, (int, float)):
+        return float(value)
+    m = re.match(r'^\s*([0-9]*\.?[0-9]+)\s*(ms|s|m|h)?\s*$', str(value))
+    if not m:
+        raise ValueError(f"Could not parse duration '{value}'")
+    units = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
+    return float(m.group(1)) * units[m.group(2) or 's']
+
+
+def statusdb_revision(doc):
+    """ Identify the version of a piece of StatusDB data. View rows don't
+    carry a _rev, so fall back to a hash of the content. """
+    if isinstance(doc, dict) and '_rev' in doc:
+        return doc['_rev']
+    return hashlib.sha1(json.dumps(doc, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+
+def write_json_atomic(path, data):
+    """ Write JSON to a file via a temporary file, so that concurrent
+    MultiQC runs never see a half-written file """
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as fh:
+        json.dump(data, fh)
+    os.replace(tmp_path, path)
+
+
+def read_json(path):
+    """ Read a JSON file, returning None if it is missing or unreadable """
+    try:
+        with open(path, 'r') as fh:
+            return json.load(fh)
+    except (IOError, ValueError):
+        return None
+
+
+def load_statusdb_config():
+    """ Read the StatusDB credentials from ~/.ngi_config/statusdb.yaml or
+    the file in $STATUS_DB_CONFIG. Returns (username, password, url) or None. """
+    conf_file = os.path.join(os.environ.get('HOME'), '.ngi_config', 'statusdb.yaml')
+    try:
+        with open(conf_file, "r") as f:
+            sdb_config = yaml.safe_load(f)
+            log.debug("Got MultiQC_NGI statusdb config from the home directory.")
+    except IOError:
+        log.debug(f"Could not open the MultiQC_NGI statusdb config file {conf_file}")
+        try:
+            with open(os.environ['STATUS_DB_CONFIG'], "r") as f:
+                sdb_config = yaml.safe_load(f)
+                log.debug(f"Got MultiQC_NGI statusdb config from $STATUS_DB_CONFIG: {os.environ['STATUS_DB_CONFIG']}")
+        except (KeyError, IOError):
+            log.debug("Could not get the MultiQC_NGI statusdb config file from env STATUS_DB_CONFIG")
+            log.warning("Could not find a statusdb config file")
+            return None
+    try:
+        couch_user = sdb_config['statusdb']['username']
+        password = sdb_config['statusdb']['password']
+        couch_url = sdb_config['statusdb']['url']
+    except KeyError:
+        log.error(f"Error parsing the config file {conf_file}")
+        return None
+    return couch_user, password, couch_url
+
+
+class TimeBudget():
+    """ Split a total time budget across the StatusDB phases of a run.
+    Each phase gets its share of whatever time is left when it starts,
+    so time saved in early phases carries over to later ones. """
+
+    PHASES = OrderedDict([('connect', 0.15), ('fetch', 0.45), ('push', 0.40)])
+
+    def __init__(self, total):
+        self.total = total
+        self.start = time.monotonic()
+        self.phase = None
+        self.phase_end = None
+
+    def start_phase(self, phase):
+        self.phase = phase
+        if self.total is None:
+            return None
+        phases = list(self.PHASES.keys())
+        share = self.PHASES[phase] / sum(self.PHASES[p] for p in phases[phases.index(phase):])
+        left = max(0.0, self.total - (time.monotonic() - self.start))
+        self.phase_end = time.monotonic() + left * share
+        return self.remaining()
+
+    def remaining(self):
+        """ Seconds left in the current phase, or None if there is no budget """
+        if self.phase_end is None:
+            return None
+        return max(0.0, self.phase_end - time.monotonic())
+
+
+class StatusDBSessionCache():
+    """ StatusDB session cookie saved on disk (readable by the owner only)
+    so that it can be shared by concurrent and later MultiQC runs """
+
+    def __init__(self, session_file, username, url):
+        self.session_file = session_file
+        self.username = username
+        self.url = url
+        self.host = urlparse(f"https://{url}").hostname
+
+    def load(self):
+        """ Return the saved cookie if it is for this server and user and
+        isn't yet due for a refresh, otherwise None. Past the refresh time the
+        client would log in again on its first request without saving the new
+        cookie, so treat it as stale and log in under the lock instead. """
+        cookie = read_json(self.session_file)
+        if not cookie or cookie.get('url') != self.url or cookie.get('username') != self.username:
+            return None
+        now = time.time()
+        if cookie.get('refresh', 0) < now or cookie.get('expires', 0) < now + 60:
+            return None
+        return cookie
+
+    def save(self, cookie):
+        cookie = dict(cookie, url=self.url, username=self.username)
+        try:
+            os.makedirs(os.path.dirname(self.session_file), mode=0o700, exist_ok=True)
+            tmp_path = f"{self.session_file}.{os.getpid()}.tmp"
+            with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as fh:
+                json.dump(cookie, fh)
+            os.replace(tmp_path, self.session_file)
+        except (IOError, OSError) as e:
+            log.debug(f"Could not save StatusDB session cookie: {e}")
+
+    def clear(self):
+        try:
+            os.remove(self.session_file)
+        except OSError:
+            pass
+
+    @contextmanager
+    def locked(self, timeout=10):
+        """ Hold an exclusive lock on the session file while logging in.
+        Gives up waiting after `timeout` seconds and carries on without it. """
+        try:
+            os.makedirs(os.path.dirname(self.session_file), mode=0o700, exist_ok=True)
+            fh = open(f"{self.session_file}.lock", 'w')
+        except (IOError, OSError):
+            yield
+            return
+        try:
+            deadline = time.monotonic() + timeout
+            while True:
+                try:
+                    fcntl.flock(fh, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except (IOError, OSError):
+                    if time.monotonic() > deadline:
+                        log.debug("Timed out waiting for the StatusDB session lock")
+                        break
+                    time.sleep(0.1)
+            yield
+        finally:
+            fh.close()
+
+
+class StatusDBCircuitBreaker():
+    """ Persistent circuit breaker for StatusDB. After `threshold` consecutive
+    failed runs, StatusDB is skipped until `cooldown` seconds have passed.
+    State is shared between runs through a small JSON file. """
+
+    def __init__(self, state_file, threshold, cooldown):
+        self.state_file = state_file
+        self.threshold = threshold
+        self.cooldown = cooldown
+
+    def state(self):
+        return read_json(self.state_file) or {'failures': 0, 'open_until': 0}
+
+    def is_open(self):
+        return time.time() < self.state().get('open_until', 0)
+
+    def record_failure(self):
+        state = self.state()
+        state['failures'] = state.get('failures', 0) + 1
+        if state['failures'] >= self.threshold:
+            state['open_until'] = time.time() + self.cooldown
+            log.warning(f"StatusDB failed {state['failures']} times in a row - skipping it for the next {self.cooldown}s")
+        self.save(state)
+
+    def record_success(self):
+        if self.state().get('failures', 0) > 0:
+            self.save({'failures': 0, 'open_until': 0})
+
+    def save(self, state):
+        try:
+            write_json_atomic(self.state_file, state)
+        except (IOError, OSError) as e:
+            log.debug(f"Could not save StatusDB circuit breaker state: {e}")
+
+
 # NGI specific code to run after the modules have finished
 class ngi_metadata():
 
+    @profile_ngi_hook('ngi_metadata')
     def __init__(self):
 
         log.debug(f"Running MultiQC_NGI v{__version__} (after modules)")
@@ -71,6 +302,7 @@ class ngi_metadata():
 
             # Flags - overwritten when stuff works
             report.ngi['ngi_header'] = False
+            report.ngi['ngi_header_multi'] = False
 
             # Check that we're not ignoring NGI module with a command line flag
             if config.kwargs.get('disable_ngi', False) is True:
@@ -87,6 +319,23 @@ class ngi_metadata():
                 log.info("Looks like WGS data - cleaning up report")
                 self.ngi_wgs_cleanup()
 
+            # Set up the time budget, metadata cache and circuit breaker for StatusDB
+            self.budget = TimeBudget(parse_duration(getattr(config, 'ngi_time_budget', None)))
+            self.cache_dir = getattr(config, 'ngi_cache_dir', None)
+            if self.cache_dir:
+                self.cache_dir = os.path.expanduser(self.cache_dir)
+            self.breaker = None
+            if self.cache_dir:
+                self.breaker = StatusDBCircuitBreaker(
+                    os.path.join(self.cache_dir, 'statusdb_breaker.json'),
+                    int(getattr(config, 'ngi_breaker_threshold', 3)),
+                    float(getattr(config, 'ngi_breaker_cooldown', 600))
+                )
+            self.statusdb_status = None
+            self.use_cache = False
+            self.statusdb_revisions = dict()
+            self.push_doc_sizes = dict()
+
             # Are we using the dummy test data?
             self.couch = None
             self.test_data = None
@@ -94,18 +343,21 @@ class ngi_metadata():
                 log.info(f"Using test data instead of connecting to StatusDB: {config.kwargs['test_database']}")
                 with open(config.kwargs['test_database'], 'r') as tdata:
                     self.test_data = json.loads(tdata.read())
+            elif self.breaker is not None and self.breaker.is_open():
+                log.warning("Skipping StatusDB after repeated failures - will use cached NGI metadata if there is any")
+                self.use_cache = True
             else:
                 # Connect to StatusDB
                 self.couch = self.connect_statusdb()
 
             # Load and process the data
-            if self.couch is not None or self.test_data is not None:
+            if self.couch is not None or self.test_data is not None or self.use_cache:
+                self.budget.start_phase('fetch')
 
                 # Get project ID
                 pids = None
                 if 'project' in config.kwargs and config.kwargs['project'] is not None:
                     log.info(f"Using supplied NGI project id: {config.kwargs['project']}")
-                    pids = config.kwargs['project']
                     self.s_names = set()
                     try:
                         for x in report.general_stats_data:
@@ -113,10 +365,14 @@ class ngi_metadata():
                     except AttributeError:
                         for section in report.general_stats_data.values():
                             self.s_names.update(section.keys())
+                    pids = {config.kwargs['project']: sorted(self.s_names)}
                 else:
                     pids = self.find_ngi_project()
 
-                if len(pids) == 1:
+                if self.couch is None and self.use_cache and len(pids) > 0 and not self.has_cached_metadata(pids):
+                    log.warning(f"No cached NGI metadata for {', '.join(sorted(pids))} - skipping NGI metadata stuff")
+
+                elif len(pids) == 1:
                     pid = list(pids.keys())[0]
                     log.info(f"Found one NGI project id: {pid}")
 
@@ -130,24 +386,34 @@ class ngi_metadata():
                     # Add to General Stats table
                     self.general_stats_sample_meta()
 
-                    # Push MultiQC data to StatusDB
-                    if getattr(config, 'push_statusdb', None) is None:
-                        config.push_statusdb = False
-                    if config.kwargs.get('push_statusdb', None) is not None:
-                        config.push_statusdb = config.kwargs['push_statusdb']
-                    if config.push_statusdb:
-                        self.push_statusdb_multiqc_data()
-                    else:
-                        log.info("Not pushing results to StatusDB. To do this, use --push or set config push_statusdb: True")
+                    # Fingerprint the inputs and push MultiQC data to StatusDB
+                    self.fingerprint_and_push(self.push_statusdb_multiqc_data)
 
                 elif len(pids) > 1:
                     log.info(f"Found {len(pids)} NGI project IDs: {', '.join(pids)}")
-                    for pid, s_names in pids.items():
-                        self.get_ngi_samples_metadata(pid, s_names)
+
+                    # Get the metadata for all projects
+                    self.get_ngi_projects_metadata(pids)
+                    for s_meta in self.run_parallel(self.fetch_ngi_samples_metadata, pids).values():
+                        self.add_ngi_samples_metadata(s_meta)
+
+                    # Find reference genome and append it to the Fastqscreen html
+                    self.fastqscreen_genome()
+
+                    # Add to General Stats table
                     self.general_stats_sample_meta()
+
+                    # Fingerprint the inputs and push each project's MultiQC data to its own StatusDB record
+                    self.fingerprint_and_push(lambda: self.push_statusdb_projects(pids))
                 else:
                     log.info("No NGI project IDs found.")
 
+            # Let the circuit breaker know how StatusDB behaved on this run
+            if self.breaker is not None:
+                if self.statusdb_status == 'failed':
+                    self.breaker.record_failure()
+                elif self.statusdb_status == 'ok':
+                    self.breaker.record_success()
 
         except Exception as e:
             log.error(f"MultiQC_NGI v{__version__} crashed! Skipping...")
@@ -215,28 +481,74 @@ class ngi_metadata():
         return pids
 
 
-    def get_ngi_project_metadata(self, pid):
-        """ Get project metadata from statusdb """
+    def fetch_ngi_project_summaries(self, pids):
+        """ Get the project summaries for one or more projects from statusdb.
+        The summary view is keyed on [status, pid], so it is scanned once
+        for all requested projects. """
         if self.test_data is not None:
-            p_summary = self.test_data['summary']
-        else:
-            if self.couch is None:
-                return None
+            return {pid: self.test_data['summary'] for pid in pids}
+        p_view = None
+        if self.statusdb_ready():
             try:
                 p_view = self.couch.post_view(db="projects", ddoc="project", view="summary").get_result()
-            except ConnectionError:
-                log.error('CouchDB Operation timed out')
-            p_summary = None
+            except STATUSDB_ERRORS as e:
+                self.statusdb_error('Could not get project summaries from StatusDB', e)
+        p_summaries = dict()
+        if p_view is not None:
             for row in p_view['rows']:
-                if row['key'][1] == pid:
-                    p_summary = row
+                if row['key'][1] in pids:
+                    p_summaries[row['key'][1]] = row['value']
+                    self.save_cached_metadata(row['key'][1], 'summary', row['value'])
+        else:
+            for pid in pids:
+                p_summary = self.load_cached_metadata(pid, 'summary')
+                if p_summary is not None:
+                    p_summaries[pid] = p_summary
+        for pid, p_summary in p_summaries.items():
+            self.statusdb_revisions[f"{pid}_summary"] = statusdb_revision(p_summary)
+        for pid in pids:
+            if pid not in p_summaries:
+                if p_view is not None:
+                    log.error(f"statusdb returned no rows when querying {pid}")
+            else:
+                log.debug(f"Found metadata for NGI project '{p_summaries[pid]['project_name']}'")
+        return p_summaries
 
+
+    def ngi_project_header(self, p_summary):
+        """ Pick out the fields shown in the report header from a project summary """
+        header = dict()
+        keys = {
+            'contact_email':'contact',
+            'application':'application',
+            'reference_genome':'reference_genome'
+        }
+        d_keys = {
+            'customer_project_reference': 'customer_project_reference',
+            'project_type': 'type',
+            'sequencing_platform': 'sequencing_platform',
+            'sequencing_setup': 'sequencing_setup',
+            'libprep':'library_construction_method'
+
+            }
+        for i, j in keys.items():
             try:
-                p_summary = p_summary['value']
-            except TypeError:
-                log.error(f"statusdb returned no rows when querying {pid}")
-                return None
-            log.debug(f"Found metadata for NGI project '{p_summary['project_name']}'")
+                header[i] = p_summary[j]
+            except KeyError:
+                log.warn(f"Couldn't find '{j}' in project summary")
+        for i, j in d_keys.items():
+            try:
+                header[i] = p_summary['details'][j]
+            except KeyError:
+                log.warn(f"Couldn't find '{j}' in project details")
+        return header
+
+
+    def get_ngi_project_metadata(self, pid):
+        """ Get project metadata from statusdb """
+        p_summary = self.fetch_ngi_project_summaries([pid]).get(pid)
+        if p_summary is None:
+            return None
 
         config.title = f"{pid}: {p_summary['project_name']}"
         config.project_name = p_summary['project_name']
@@ -258,46 +570,70 @@ class ngi_metadata():
 
         report.ngi['pid'] = pid
         report.ngi['project_name'] = p_summary['project_name']
-        keys = {
-            'contact_email':'contact',
-            'application':'application',
-            'reference_genome':'reference_genome'
-        }
-        d_keys = {
-            'customer_project_reference': 'customer_project_reference',
-            'project_type': 'type',
-            'sequencing_platform': 'sequencing_platform',
-            'sequencing_setup': 'sequencing_setup',
-            'libprep':'library_construction_method'
+        header = self.ngi_project_header(p_summary)
+        report.ngi.update(header)
+        if len(header) > 0:
+            report.ngi['ngi_header'] = True
+
+
+    def get_ngi_projects_metadata(self, pids):
+        """ Get project metadata for a report covering several projects.
+        Each project's header fields are kept under report.ngi['projects'] """
+        p_summaries = self.fetch_ngi_project_summaries(pids)
+        report.ngi['projects'] = OrderedDict()
+        for pid in sorted(p_summaries):
+            p_summary = p_summaries[pid]
+            report.ngi['projects'][pid] = self.ngi_project_header(p_summary)
+            report.ngi['projects'][pid]['project_name'] = p_summary['project_name']
+        if len(report.ngi['projects']) == 0:
+            return None
 
-            }
-        for i, j in keys.items():
-            try:
-                report.ngi[i] = p_summary[j]
-                report.ngi['ngi_header'] = True
-            except KeyError:
-                log.warn(f"Couldn't find '{j}' in project summary")
-        for i, j in d_keys.items():
-            try:
-                report.ngi[i] = p_summary['details'][j]
-                report.ngi['ngi_header'] = True
-            except KeyError:
-                log.warn(f"Couldn't find '{j}' in project details")
+        # Keep the title and file names short - MultiQC builds the report and
+        # data dir names from the title, which can't grow with every project
+        first_pid = next(iter(report.ngi['projects']))
+        n_more = len(report.ngi['projects']) - 1
+        config.title = f"{first_pid}: {report.ngi['projects'][first_pid]['project_name']}"
+        if n_more > 0:
+            config.title += f" + {n_more} more project{'s' if n_more > 1 else ''}"
+        if config.filename is None:
+            config.filename = f"{first_pid}_plus_{n_more}_projects_multiqc_report"
+        report.ngi['ngi_header_multi'] = True
+
+        # Only show the reference genome if all projects agree on it
+        genomes = set(p.get('reference_genome') for p in report.ngi['projects'].values())
+        if len(genomes) == 1:
+            report.ngi['reference_genome'] = genomes.pop()
 
 
-    def get_ngi_samples_metadata(self, pid, s_names=None):
+    def fetch_ngi_samples_metadata(self, pid):
         """ Get project sample metadata from statusdb """
         if self.test_data is not None:
-            report.ngi['sample_meta'] = self.test_data['samples']
-        elif self.couch is not None:            
-            p_view_results = self.couch.post_view_queries(db="projects", ddoc="project", queries=[cloudant_v1.ViewQuery(key=pid)],
-                                                   view="samples").get_result()
-            if not len(p_view_results['results'][0]['rows']) == 1:
-                log.error(f"statusdb returned {len(p_view_results['results'][0]['rows'])} rows when querying {pid}")
+            s_meta = self.test_data['samples']
+        elif not self.statusdb_ready():
+            s_meta = self.load_cached_metadata(pid, 'samples') or dict()
+        else:
+            try:
+                p_view_results = self.couch.post_view_queries(db="projects", ddoc="project", queries=[cloudant_v1.ViewQuery(key=pid)],
+                                                       view="samples").get_result()
+            except STATUSDB_ERRORS as e:
+                self.statusdb_error(f'Could not get sample metadata for {pid} from StatusDB', e)
+                s_meta = self.load_cached_metadata(pid, 'samples') or dict()
             else:
-                if 'sample_meta' not in report.ngi:
-                    report.ngi['sample_meta'] = dict()
-                report.ngi['sample_meta'].update(p_view_results['results'][0]['rows'][0]['value'])
+                if not len(p_view_results['results'][0]['rows']) == 1:
+                    log.error(f"statusdb returned {len(p_view_results['results'][0]['rows'])} rows when querying {pid}")
+                    return dict()
+                s_meta = p_view_results['results'][0]['rows'][0]['value']
+                self.save_cached_metadata(pid, 'samples', s_meta)
+        self.statusdb_revisions[f"{pid}_samples"] = statusdb_revision(s_meta)
+        return s_meta
+
+
+    def add_ngi_samples_metadata(self, s_meta):
+        """ Add sample metadata to the report and update the NGI name mapping """
+        if s_meta:
+            if 'sample_meta' not in report.ngi:
+                report.ngi['sample_meta'] = dict()
+            report.ngi['sample_meta'].update(s_meta)
 
         if 'ngi_names' not in report.ngi:
             report.ngi['ngi_names'] = dict()
@@ -306,6 +642,87 @@ class ngi_metadata():
         report.ngi['ngi_names_json'] = json.dumps(report.ngi['ngi_names'], indent=4)
 
 
+    def get_ngi_samples_metadata(self, pid):
+        """ Get project sample metadata from statusdb and add it to the report """
+        self.add_ngi_samples_metadata(self.fetch_ngi_samples_metadata(pid))
+
+
+    def run_parallel(self, func, pids):
+        """ Run func(pid) for each project concurrently, with at most
+        config.ngi_max_workers StatusDB requests in flight at once.
+        Stops waiting when the time budget for the current phase runs out.
+        Returns a dict of pid: result, leaving out projects that failed. """
+        results = dict()
+        if len(pids) == 0:
+            return results
+        max_workers = max(1, min(int(getattr(config, 'ngi_max_workers', 4)), len(pids)))
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        futures = {executor.submit(func, pid): pid for pid in pids}
+        done, not_done = wait(futures, timeout=self.budget.remaining())
+        executor.shutdown(wait=False, cancel_futures=True)
+        for future, pid in futures.items():
+            if future in not_done:
+                self.statusdb_error(f"Ran out of time waiting for StatusDB for project {pid}")
+                continue
+            try:
+                results[pid] = future.result()
+            except Exception as e:
+                log.error(f"StatusDB request failed for project {pid}: {e}")
+        return results
+
+
+    def statusdb_ready(self):
+        """ Check that we can still query StatusDB within the time budget,
+        and limit the HTTP timeout of the next request to the time left """
+        if self.couch is None:
+            return False
+        timeout = self.budget.remaining()
+        if timeout is None:
+            return True
+        if timeout <= 0:
+            self.statusdb_error(f"MultiQC_NGI time budget for StatusDB {self.budget.phase} used up - skipping")
+            return False
+        self.couch.set_http_config({'timeout': timeout})
+        return True
+
+
+    def statusdb_error(self, msg, e=None):
+        """ Log a StatusDB failure and remember it for the circuit breaker """
+        log.error(f"{msg}: {e}" if e is not None else msg)
+        self.statusdb_status = 'failed'
+
+
+    def save_cached_metadata(self, pid, kind, data):
+        """ Keep a copy of StatusDB metadata to fall back on when it can't be reached """
+        if not self.cache_dir:
+            return None
+        try:
+            write_json_atomic(self.cached_metadata_path(pid, kind), data)
+        except (IOError, OSError) as e:
+            log.debug(f"Could not cache StatusDB {kind} for {pid}: {e}")
+
+
+    def load_cached_metadata(self, pid, kind):
+        """ Load StatusDB metadata saved by a previous run """
+        if not self.cache_dir:
+            return None
+        data = read_json(self.cached_metadata_path(pid, kind))
+        if data is not None:
+            log.info(f"Using cached StatusDB {kind} for {pid}")
+        else:
+            log.warning(f"No cached StatusDB {kind} for {pid}")
+        return data
+
+
+    def has_cached_metadata(self, pids):
+        """ Check whether any of the projects have cached metadata to fall back on """
+        return bool(self.cache_dir) and any(os.path.isfile(self.cached_metadata_path(pid, 'summary')) for pid in pids)
+
+
+    def cached_metadata_path(self, pid, kind):
+        return os.path.join(self.cache_dir, 'statusdb', f"{pid}_{kind}.json")
+
+
     def fastqscreen_genome(self):
         """Add the Refrence genome from statusdb to fastq_screen html"""
         if report.ngi.get('reference_genome') is not None:
@@ -491,9 +908,85 @@ class ngi_metadata():
 
 
 
-    def push_statusdb_multiqc_data(self):
+    def ngi_fingerprint(self):
+        """ Fingerprint everything that goes into the StatusDB push and the
+        report: the input files, the plugin and MultiQC versions and the
+        StatusDB metadata used. Saved to the data dir and report.ngi. """
+        files = list()
+        for module_id, module_files in report.files.items():
+            for f in module_files:
+                path = os.path.join(f['root'], f['fn'])
+                try:
+                    st = os.stat(path)
+                    files.append([module_id, path, st.st_size, int(st.st_mtime)])
+                except OSError:
+                    files.append([module_id, path, None, None])
+        components = {
+            'files': sorted(files, key=lambda x: [str(i) for i in x]),
+            'MultiQC_version': config.version,
+            'MultiQC_NGI_version': __version__,
+            'statusdb_revisions': self.statusdb_revisions,
+        }
+        fingerprint = hashlib.sha256(json.dumps(components, sort_keys=True).encode('utf-8')).hexdigest()
+        report.ngi['fingerprint'] = fingerprint
+        log.debug(f"MultiQC_NGI fingerprint: {fingerprint}")
+        report.write_data_file({
+            'fingerprint': fingerprint,
+            'MultiQC_version': config.version,
+            'MultiQC_NGI_version': __version__,
+            'statusdb_revisions': self.statusdb_revisions,
+            'n_files': len(files),
+        }, 'multiqc_ngi_fingerprint', data_format='json')
+        return fingerprint
+
+
+    def push_statusdb_enabled(self):
+        """ Work out whether to push to StatusDB from the config and command line """
+        if getattr(config, 'push_statusdb', None) is None:
+            config.push_statusdb = False
+        if config.kwargs.get('push_statusdb', None) is not None:
+            config.push_statusdb = config.kwargs['push_statusdb']
+        return config.push_statusdb
+
+
+    def statusdb_push_possible(self):
+        """ Warn if a push was requested but StatusDB can't be reached,
+        eg. when running on cached metadata """
+        if self.couch is None and self.use_cache:
+            log.warning("StatusDB unavailable - results NOT pushed")
+            return False
+        return True
+
+
+    def fingerprint_and_push(self, push):
+        """ Fingerprint the inputs, so that unchanged re-runs can skip the
+        push and transfer, then call push if pushing is enabled and possible """
+        self.ngi_fingerprint()
+        if self.push_statusdb_enabled():
+            if self.statusdb_push_possible():
+                self.budget.start_phase('push')
+                push()
+        else:
+            log.info("Not pushing results to StatusDB. To do this, use --push or set config push_statusdb: True")
+
+
+    def push_statusdb_projects(self, pids):
+        """ Push each project's subset of the MultiQC data in a multi-project
+        report to its own analysis record, in parallel """
+        def push_project(pid):
+            return self.push_statusdb_multiqc_data(
+                pid,
+                report.ngi['projects'][pid]['project_name'],
+                set(pids[pid])
+            )
+        self.run_parallel(push_project, [pid for pid in pids if pid in report.ngi.get('projects', {})])
+
+
+    def push_statusdb_multiqc_data(self, pid=None, project_name=None, s_names=None):
         """ Push data parsed by MultiQC modules to the analysis database
-        in statusdb. """
+        in statusdb. Defaults to the single project in the report header;
+        for multi-project reports, pass the project and its sample names
+        to only push that project's subset of the data. """
 
         # StatusDB view code for analysis/project_id view:
         # function(doc) {
@@ -501,15 +994,19 @@ class ngi_metadata():
         #   emit(project_id, doc);
         # }
 
+        if pid is None:
+            pid = report.ngi['pid']
+            project_name = report.ngi['project_name']
+
         # Connect to the analysis database
-        if self.couch is None:
+        if not self.statusdb_ready():
             return None
         try:
             p_view_results = self.couch.post_view_queries(db="analysis", ddoc="project", 
-                                                          queries=[cloudant_v1.ViewQuery(key=report.ngi['pid'])],
+                                                          queries=[cloudant_v1.ViewQuery(key=pid)],
                                                           view="project_id").get_result()
-        except ConnectionError:
-            log.error('CouchDB Operation timed out')
+        except STATUSDB_ERRORS as e:
+            self.statusdb_error(f'Could not get the analysis record for {pid} from StatusDB', e)
             return None
 
         # Try to get an existing document if one exists
@@ -520,8 +1017,8 @@ class ngi_metadata():
         # Start fresh unless the existing doc looks similar
         newdoc = {
             'entity_type': 'MultiQC_data',
-            'project_id': report.ngi['pid'],
-            'project_name': report.ngi['project_name'],
+            'project_id': pid,
+            'project_name': project_name,
             'MultiQC_version': config.version,
             'MultiQC_NGI_version': config.multiqc_ngi_version,
         }
@@ -530,16 +1027,27 @@ class ngi_metadata():
                 assert(doc[k] == newdoc[k])
             except (KeyError, AssertionError):
                 doc = newdoc
-                log.info('Creating new analysis record in StatusDB')
+                log.info(f'Creating new analysis record in StatusDB for {pid}')
                 break
         if doc != newdoc:
-            log.info('Updating existing analysis record in StatusDB')
+            log.info(f'Updating existing analysis record in StatusDB for {pid}')
+
+        # Nothing to do if this exact data has been pushed before
+        fingerprint = report.ngi.get('fingerprint')
+        if fingerprint is not None and doc.get('MultiQC_NGI_fingerprint') == fingerprint:
+            if config.kwargs.get('force_ngi', False) is not True:
+                log.info(f"Analysis record for {pid} is already up to date - skipping push. Use --force-ngi to push anyway")
+                return None
+        if fingerprint is not None:
+            doc['MultiQC_NGI_fingerprint'] = fingerprint
 
         # Add sample metadata to doc
         if 'samples' not in doc:
             doc['samples'] = dict()
         for key, d in report.saved_raw_data.items():
             for s_name in d:
+                if s_names is not None and s_name not in s_names:
+                    continue
                 m = re.search(r'(P\d{3,5}_\d{1,6})', s_name)
                 if m:
                     sid = m.group(1)
@@ -549,64 +1057,144 @@ class ngi_metadata():
                     doc['samples'][sid] = dict()
                 doc['samples'][sid][key] = d[s_name]
 
+        if config.kwargs.get('ngi_profile', False) is True:
+            self.push_doc_sizes[pid] = json_size(doc)
+
         # Save object to the database
+        if not self.statusdb_ready():
+            return None
         try:
-            self.couch.post_document(db="analysis", document=doc).get_result()
+            result = self.couch.post_document(db="analysis", document=doc).get_result()
         except ApiException as e:
-            if e.message[0] == 'bad_request: invalid UTF-8 JSON':
-                log.debug('Error saving to StatusDB: bad_request: invalid UTF-8 JSON, might be NaNs, trying again...')
-                doc = json.loads(utils.util_functions.dump_json(doc, filehandle=None))
-                self.couch.post_document(db="analysis", document=doc).get_result()
-                log.debug('Saved to StatusDB after converting NaNs to nulls')
-            else:
-                log.error(f'Error saving to StatusDB: {e}')
-                
+            if e.message[0] != 'bad_request: invalid UTF-8 JSON':
+                self.statusdb_error('Error saving to StatusDB', e)
+                return None
+            log.debug('Error saving to StatusDB: bad_request: invalid UTF-8 JSON, might be NaNs, trying again...')
+            doc = json.loads(utils.util_functions.dump_json(doc, filehandle=None))
+            if not self.statusdb_ready():
+                return None
+            try:
+                result = self.couch.post_document(db="analysis", document=doc).get_result()
+            except STATUSDB_ERRORS as e:
+                self.statusdb_error('Error saving to StatusDB', e)
+                return None
+            log.debug('Saved to StatusDB after converting NaNs to nulls')
+        except STATUSDB_ERRORS as e:
+            self.statusdb_error('Error saving to StatusDB', e)
+            return None
+
+        # Keep a local columnar copy of the pushed metrics
+        self.save_metrics_db(doc, result.get('id'))
+
+
+    def save_metrics_db(self, doc, doc_id):
+        """ Write the pushed metrics to the local SQLite table set with config.ngi_metrics_db """
+        metrics_db = getattr(config, 'ngi_metrics_db', None)
+        if not metrics_db:
+            return None
+        try:
+            with MetricsStore(metrics_db) as store:
+                n_rows = store.write_doc(doc, doc_id)
+            log.debug(f"Wrote {n_rows} metrics for {doc['project_id']} to {metrics_db}")
+        except (sqlite3.Error, OSError, ValueError) as e:
+            log.error(f"Could not write metrics to {metrics_db}: {e}")
 
 
     def connect_statusdb(self):
         """ Connect to statusdb """
-        conf_file = os.path.join(os.environ.get('HOME'), '.ngi_config', 'statusdb.yaml')
-        try:
-            with open(conf_file, "r") as f:
-                sdb_config = yaml.safe_load(f)
-                log.debug("Got MultiQC_NGI statusdb config from the home directory.")
-        except IOError:
-            log.debug(f"Could not open the MultiQC_NGI statusdb config file {conf_file}")
-            try:
-                with open(os.environ['STATUS_DB_CONFIG'], "r") as f:
-                    sdb_config = yaml.safe_load(f)
-                    log.debug(f"Got MultiQC_NGI statusdb config from $STATUS_DB_CONFIG: {os.environ['STATUS_DB_CONFIG']}")
-            except (KeyError, IOError):
-                log.debug("Could not get the MultiQC_NGI statusdb config file from env STATUS_DB_CONFIG")
-                log.warning("Could not find a statusdb config file")
-                return None
-        try:
-            couch_user = sdb_config['statusdb']['username']
-            password = sdb_config['statusdb']['password']
-            couch_url = sdb_config['statusdb']['url']
-        except KeyError:
-            log.error(f"Error parsing the config file {conf_file}")
+        sdb_config = load_statusdb_config()
+        if sdb_config is None:
             return None
+        couch_user, password, couch_url = sdb_config
 
         server_url = f"https://{couch_user}:{password}@{couch_url}"
 
+        # Look for a session cookie saved by an earlier run
+        session_cache = None
+        cookie = None
+        if self.cache_dir:
+            session_cache = StatusDBSessionCache(os.path.join(self.cache_dir, 'statusdb_session.json'), couch_user, couch_url)
+            cookie = session_cache.load()
+
         # First, test that we can see the server.
+        # With a saved session cookie, check that it is still accepted at the same time.
+        timeout = self.budget.start_phase('connect')
         try:
-            requests.get(server_url, timeout=3)
+            if cookie is not None:
+                r = requests.get(f"https://{couch_url}/_session", cookies={'AuthSession': cookie['value']},
+                                 timeout=3 if timeout is None else min(3, timeout))
+                try:
+                    session_user = r.json().get('userCtx', {}).get('name')
+                except ValueError:
+                    session_user = None
+                if session_user != couch_user:
+                    log.debug("Saved StatusDB session cookie was rejected - logging in again")
+                    session_cache.clear()
+                    cookie = None
+            else:
+                requests.get(server_url, timeout=3 if timeout is None else min(3, timeout))
         except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
-            log.warning("Cannot contact statusdb - skipping NGI metadata stuff")
+            if self.cache_dir:
+                log.warning("Cannot contact statusdb - will use cached NGI metadata if there is any")
+            else:
+                log.warning("Cannot contact statusdb - skipping NGI metadata stuff")
+            self.statusdb_status = 'failed'
+            self.use_cache = bool(self.cache_dir)
             return None
+        self.statusdb_status = 'ok'
 
         couch_server = cloudant_v1.CloudantV1(authenticator=CouchDbSessionAuthenticator(couch_user, password))
         couch_server.set_service_url(f"https://{couch_url}")
-        
+        if self.budget.remaining() is not None:
+            couch_server.set_http_config({'timeout': self.budget.remaining()})
+        if session_cache is not None:
+            self.statusdb_session(couch_server, session_cache, cookie)
+
         return couch_server
 
 
+    def statusdb_session(self, couch_server, session_cache, cookie):
+        """ Share one StatusDB session cookie between runs, so that each run
+        doesn't need its own _session login. If there is no valid saved cookie,
+        log in while holding the lock and save the new cookie for other runs. """
+        token_manager = couch_server.authenticator.token_manager
+        if cookie is None:
+            lock_timeout = 10
+            if self.budget.remaining() is not None:
+                lock_timeout = min(lock_timeout, self.budget.remaining())
+            with session_cache.locked(timeout=lock_timeout):
+                # Another run may have logged in while we were waiting for the lock
+                cookie = session_cache.load()
+                if cookie is None:
+                    try:
+                        token_manager.get_token()
+                    except (StopIteration, *STATUSDB_ERRORS) as e:
+                        log.debug(f"Could not log in to StatusDB: {e}")
+                        return None
+                    for c in couch_server.get_http_client().cookies:
+                        if c.name == 'AuthSession':
+                            session_cache.save({
+                                'value': c.value,
+                                'expires': token_manager.expire_time,
+                                'refresh': token_manager.refresh_time
+                            })
+                    return None
+
+        # Hand the saved cookie to the client, which will then only log in
+        # again once the cookie is due to be refreshed
+        couch_server.get_http_client().cookies.set_cookie(requests.cookies.create_cookie(
+            'AuthSession', cookie['value'], domain=session_cache.host, path='/'
+        ))
+        token_manager.expire_time = cookie['expires']
+        token_manager.refresh_time = cookie['refresh']
+        log.debug("Using saved StatusDB session cookie")
+
+
 
 # NGI code to run once the report is finished and has been written to disk
 class ngi_after_execution_finish():
 
+    @profile_ngi_hook('ngi_after_execution_finish')
     def __init__(self):
         log.debug(f"Running MultiQC_NGI v{__version__} (after execution finish)")
 
@@ -617,8 +1205,21 @@ class ngi_after_execution_finish():
         # Global try statement to catch any unhandled exceptions and stop MultiQC from crashing
         try:
 
-            # Copy finished reports to remote server
-            if getattr(config, 'save_remote', False) is True:
+            # Copy finished reports to remote server, unless this exact report has been copied before
+            fingerprint = report.ngi.get('fingerprint')
+            transfers_file = None
+            if getattr(config, 'ngi_cache_dir', None):
+                transfers_file = os.path.join(os.path.expanduser(config.ngi_cache_dir), 'transfers.json')
+            transfer_key = f"{getattr(config, 'remote_destination', None)}/{os.path.basename(config.output_fn_name)}"
+            transfers = (read_json(transfers_file) if transfers_file else None) or dict()
+            if (
+                getattr(config, 'save_remote', False) is True
+                and fingerprint is not None
+                and transfers.get(transfer_key) == fingerprint
+                and config.kwargs.get('force_ngi', False) is not True
+            ):
+                log.info("Report is unchanged since it was last copied to the remote server - skipping. Use --force-ngi to copy anyway")
+            elif getattr(config, 'save_remote', False) is True:
                 scp_command = ['scp']
                 if getattr(config, 'remote_sshkey', None) is not None:
                     scp_command.extend(['-i', config.remote_sshkey])
@@ -631,6 +1232,12 @@ class ngi_after_execution_finish():
                 pid, exit_status = os.waitpid(p.pid, 0)
                 if exit_status != 0:
                     log.error("Not able to copy report to remote server: Subprocess command failed.")
+                elif fingerprint is not None and transfers_file is not None:
+                    transfers[transfer_key] = fingerprint
+                    try:
+                        write_json_atomic(transfers_file, transfers)
+                    except (IOError, OSError) as e:
+                        log.debug(f"Could not save report transfer record: {e}")
 
         except Exception as e:
             log.error(f"MultiQC_NGI v{__version__} crashed! Skipping...")
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+""" CPU and memory profiling of the MultiQC_NGI hooks, switched on with
+--ngi-profile. Each profiled hook writes multiqc_ngi_profile_<hook>.json
+to the data directory. """
+
+import cProfile
+import functools
+import glob
+import json
+import logging
+import os
+import pstats
+import time
+import tracemalloc
+
+from multiqc import config, report
+
+log = logging.getLogger('multiqc')
+
+# How many functions / allocation sites to keep in the profile
+N_TOP = 25
+
+
+def json_size(data):
+    """ Size in bytes of data serialised as JSON """
+    return len(json.dumps(data, default=str))
+
+
+def profile_ngi_hook(hook):
+    """ Decorator for the __init__ of a hook class. With --ngi-profile, runs
+    the hook under cProfile with tracemalloc enabled and saves the results. """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if config.kwargs.get('ngi_profile', False) is not True:
+                return func(self, *args, **kwargs)
+
+            started_tracing = not tracemalloc.is_tracing()
+            if started_tracing:
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+            memory_start = tracemalloc.get_traced_memory()[0]
+            profiler = cProfile.Profile()
+            wall_start = time.perf_counter()
+            cpu_start = time.process_time()
+            try:
+                return profiler.runcall(func, self, *args, **kwargs)
+            finally:
+                wall_seconds = time.perf_counter() - wall_start
+                cpu_seconds = time.process_time() - cpu_start
+                memory_end, memory_peak = tracemalloc.get_traced_memory()
+                snapshot = tracemalloc.take_snapshot()
+                if started_tracing:
+                    tracemalloc.stop()
+                try:
+                    profile = {
+                        'hook': hook,
+                        'wall_seconds': wall_seconds,
+                        'cpu_seconds': cpu_seconds,
+                        'memory_start_bytes': memory_start,
+                        'memory_end_bytes': memory_end,
+                        'memory_peak_bytes': memory_peak,
+                        'top_functions': top_functions(profiler),
+                        'top_allocations': top_allocations(snapshot),
+                        'sizes_bytes': data_sizes(self),
+                    }
+                    save_profile(hook, profile)
+                    log.info(f"MultiQC_NGI {hook}: {wall_seconds:.2f}s, peak memory {memory_peak / 1024 / 1024:.1f} MiB")
+                except Exception as e:
+                    log.error(f"Could not save MultiQC_NGI profile for {hook}: {e}")
+        return wrapper
+    return decorator
+
+
+def top_functions(profiler):
+    """ The functions with the highest cumulative time """
+    stats = pstats.Stats(profiler)
+    rows = list()
+    for (fn, line, func), (cc, nc, tt, ct, callers) in stats.stats.items():
+        rows.append({
+            'function': f"{fn}:{line}({func})",
+            'calls': nc,
+            'total_seconds': tt,
+            'cumulative_seconds': ct,
+        })
+    return sorted(rows, key=lambda x: x['cumulative_seconds'], reverse=True)[:N_TOP]
+
+
+def top_allocations(snapshot):
+    """ The source lines holding the most memory when the hook finished """
+    return [
+        {'line': str(stat.traceback), 'size_bytes': stat.size, 'count': stat.count}
+        for stat in snapshot.statistics('lineno')[:N_TOP]
+    ]
+
+
+def data_sizes(hook_obj):
+    """ Sizes of the main data structures built by the plugin """
+    sizes = {
+        'report.ngi': json_size(report.ngi),
+        'sample_meta': json_size(report.ngi.get('sample_meta', {})),
+    }
+    for pid, n_bytes in getattr(hook_obj, 'push_doc_sizes', {}).items():
+        sizes[f"push_document.{pid}"] = n_bytes
+    return sizes
+
+
+def find_data_dir():
+    """ Find the data directory written by this run. MultiQC doesn't expose
+    its final path and may rename it after the report, so look for the
+    directory under the output dir with the newest MultiQC data files. """
+    if getattr(config, 'data_dir', None) and os.path.isdir(config.data_dir):
+        return config.data_dir
+    newest = None
+    newest_mtime = None
+    for d in glob.glob(os.path.join(config.output_dir, '*', '')):
+        for marker in ('multiqc_ngi_profile_ngi_metadata.json', 'multiqc_data.json'):
+            path = os.path.join(d, marker)
+            if os.path.isfile(path):
+                mtime = os.path.getmtime(path)
+                if newest_mtime is None or mtime > newest_mtime:
+                    newest, newest_mtime = d, mtime
+                break
+    return newest
+
+
+def save_profile(hook, profile):
+    """ Save a hook profile in the data directory. Hooks that run before the
+    report is written use MultiQC's data files, later hooks write to the
+    data directory that this run has just written. """
+    fn = f"multiqc_ngi_profile_{hook}"
+    if hook == 'ngi_metadata':
+        report.write_data_file(profile, fn, data_format='json')
+        return None
+    out_dir = find_data_dir()
+    if out_dir is None:
+        log.warning(f"Could not find the data directory - saving {fn}.json to {config.output_dir}")
+        out_dir = config.output_dir
+    with open(os.path.join(out_dir, f"{fn}.json"), 'w') as fh:
+        json.dump(profile, fh, indent=4)
@@ -52,6 +52,7 @@ setup(
     license = 'MIT',
     packages = find_packages(),
     include_package_data = True,
+    python_requires = '>=3.9',
     install_requires = [
         'ibmcloudant>=0.9.1',
         'simplejson',
@@ -60,6 +61,9 @@ setup(
         'multiqc>=1.22.dev0'
     ],
     entry_points = {
+        'console_scripts': [
+            'multiqc_ngi = multiqc_ngi.cli:multiqc_ngi',
+        ],
         'multiqc.templates.v1': [
             'ngi = multiqc_ngi.templates.ngi',
             'genstat = multiqc_ngi.templates.genstat',
@@ -68,6 +72,8 @@ setup(
             'disable = multiqc_ngi.cli:disable_ngi',
             'project = multiqc_ngi.cli:pid_option',
             'push_statusdb = multiqc_ngi.cli:push_flag',
+            'force_ngi = multiqc_ngi.cli:force_ngi',
+            'ngi_profile = multiqc_ngi.cli:ngi_profile',
             'test_db = multiqc_ngi.cli:test_db'
         ],
         'multiqc.hooks.v1': [